@@ -1,13 +1,18 @@
-import json
+import asyncio
+import hmac
 import logging
 import os
 import re
-import tempfile
-import shutil
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import Literal
 
 import httpx
+import orjson
+from cachetools import TTLCache
 from fastapi import FastAPI, Request, Response, HTTPException
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, HttpUrl
 
 from telegram import Update
 from telegram.ext import (
@@ -20,92 +25,41 @@ from telegram.ext import (
 )
 
 from app.config import get_settings
-
-# Video download/upload imports
-import yt_dlp
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from app import tasks
 
 # Logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("app")
 
-# App & settings
-app = FastAPI(title="Telegram Webhook + FastAPI")
+# Settings
 settings = get_settings()
+_EXPECTED_SECRET = settings.WEBHOOK_SECRET_TOKEN.encode()
 
 # ---------------------- Core Text Logic ----------------------
+_PREFIX = "bhola "
+
 def process_text(text: str) -> str:
-    return f"bhola {text}"
+    return _PREFIX + text
 
 class In(BaseModel):
     text: str
 
-class Out(BaseModel):
-    result: str
-
-# ---------------------- YouTube Helpers ----------------------
-def download_video(url: str) -> str:
-    """
-    Downloads a video to a new temp directory and returns the full local file path.
-    Temp directory lives under the OS temp dir (e.g. %TEMP% on Windows, /tmp on Linux/Mac).
-    """
-    tmpdir = tempfile.mkdtemp(prefix="yt_simple_")
-    outtmpl = os.path.join(tmpdir, "%(title)s.%(ext)s")
-
-    ydl_opts = {
-        "outtmpl": outtmpl,
-        "format": "best",
-        "noplaylist": True,
-        "quiet": True,
-    }
-
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=True)
-        filename = ydl.prepare_filename(info)  # full path to downloaded file
-
-    return filename  # e.g. C:\Users\...\AppData\Local\Temp\yt_simple_xxx\My Video.mp4
-
-
-def build_youtube_client():
-    creds = Credentials(
-        token=None,
-        refresh_token=os.getenv("YT_REFRESH_TOKEN"),
-        client_id=os.getenv("YT_CLIENT_ID"),
-        client_secret=os.getenv("YT_CLIENT_SECRET"),
-        token_uri="https://oauth2.googleapis.com/token",
-        scopes=["https://www.googleapis.com/auth/youtube.upload"],
-    )
-    return build("youtube", "v3", credentials=creds, cache_discovery=False)
-
-
-def upload_to_youtube(video_path: str, title: str | None = None, description: str | None = None, privacy: str = "private") -> str:
-    youtube = build_youtube_client()
-
-    body = {
-        "snippet": {
-            "title": title or "Uploaded via Bot",
-            "description": description or "Auto-uploaded video",
-        },
-        "status": {"privacyStatus": privacy},
-    }
-
-    media = MediaFileUpload(video_path, chunksize=1024 * 1024, resumable=True)
-
-    request = youtube.videos().insert(
-        part="snippet,status", body=body, media_body=media
-    )
-
-    response = None
-    while response is None:
-        _, response = request.next_chunk()
-
-    return response.get("id")
+class UrlUploadIn(BaseModel):
+    url: HttpUrl
+    title: str | None = None
+    description: str | None = None
+    privacy: Literal["private", "unlisted", "public"] = "private"
 
 # ---------------------- Telegram App ----------------------
 tg_app: Application = ApplicationBuilder().token(settings.TELEGRAM_BOT_TOKEN).build()
 
+_URL_RE = re.compile(r"https?://\S+")
+
+# (chat_id, url) of uploads still in progress, so a chat re-sending the same
+# URL doesn't kick off another download. In-process, like the update dedupe
+# below; the Dockerfile runs a single worker for that reason.
+_recent_urls: TTLCache = TTLCache(maxsize=10_000, ttl=60 * 60)
+
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Hello! Send me text or a URL.")
 
@@ -117,28 +71,27 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = msg.text.strip()
 
     # Check for URLs
-    url_match = re.search(r"(https?://\S+)", text)
+    url_match = _URL_RE.search(text)
     if url_match:
-        url = url_match.group(1)
-        await msg.reply_text("✅ URL detected. Downloading video...")
+        url = url_match.group(0)
+        key = (msg.chat_id, url)
+        if key in _recent_urls:
+            logger.info("Dropping duplicate URL from chat %s: %s", msg.chat_id, url)
+            return
 
-        try:
-            path = download_video(url)
-            vid = upload_to_youtube(path)
-            link = f"https://youtu.be/{vid}"
-            await msg.reply_text(f"✅ Uploaded successfully!\n{link}")
-        except Exception as e:
-            await msg.reply_text(f"❌ Error: {str(e)}")
-        finally:
-            # cleanup temp dir/file
-            try:
-                if path:
-                    tmpdir = os.path.dirname(path)
-                    if os.path.exists(tmpdir):
-                        shutil.rmtree(tmpdir, ignore_errors=True)
-            except Exception:
-                pass
+        await msg.reply_text("✅ URL detected. Downloading video...")
 
+        async def notify(job: dict):
+            _recent_urls.pop(key, None)
+            if job["status"] == "done":
+                await msg.reply_text(f"✅ Uploaded successfully!\n{job['link']}")
+            else:
+                await msg.reply_text(f"❌ Error: {job['error']}")
+
+        # Heavy lifting happens on the job workers, not in the update handler.
+        # Marked only now: if the reply above failed, a resend must go through.
+        _recent_urls[key] = True
+        tasks.enqueue(app.state.job_queue, url, on_done=notify)
         return
 
     # Otherwise simple text processing
@@ -148,47 +101,129 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 tg_app.add_handler(CommandHandler("start", cmd_start))
 tg_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
 
+# Updates are acked immediately and queued per chat. Each chat's queue is
+# drained by its own task every COALESCE_WINDOW seconds, in order, dropping
+# Telegram redeliveries; UPDATE_CONCURRENCY caps updates handled at once.
+UPDATE_CONCURRENCY = 20
+COALESCE_WINDOW = 0.05
+_chat_queues: defaultdict[int, asyncio.Queue] = defaultdict(asyncio.Queue)
+_chat_tasks: dict[int, asyncio.Task] = {}
+_seen_updates: TTLCache = TTLCache(maxsize=10_000, ttl=10 * 60)
+
+async def _process_update(update: Update):
+    async with app.state.update_slots:
+        try:
+            await tg_app.process_update(update)
+        except Exception:
+            logger.exception("Failed to process update %s", update.update_id)
+
+async def _drain_chat(chat_id: int):
+    queue = _chat_queues[chat_id]
+    while True:
+        await asyncio.sleep(COALESCE_WINDOW)
+        if queue.empty():
+            # no await between the check and the cleanup, so schedule_update
+            # can't slip an update in unnoticed
+            del _chat_queues[chat_id]
+            del _chat_tasks[chat_id]
+            return
+
+        batch = [queue.get_nowait() for _ in range(queue.qsize())]
+        for update in batch:
+            await _process_update(update)
+
+def schedule_update(update: Update):
+    if update.update_id in _seen_updates:
+        return
+    _seen_updates[update.update_id] = True
+
+    chat_id = update.effective_chat.id if update.effective_chat else 0
+    _chat_queues[chat_id].put_nowait(update)
+    if chat_id not in _chat_tasks:
+        _chat_tasks[chat_id] = asyncio.create_task(_drain_chat(chat_id))
+
 # ---------------------- Lifecycle ----------------------
-@app.on_event("startup")
-async def on_startup():
-    await tg_app.initialize()
-
-    if settings.PUBLIC_BASE_URL:
-        webhook = f"{settings.PUBLIC_BASE_URL.rstrip('/')}/telegram/webhook"
-        payload = {"url": webhook, "secret_token": settings.WEBHOOK_SECRET_TOKEN}
-
-        async with httpx.AsyncClient(timeout=15) as client:
-            r = await client.post(
-                f"https://api.telegram.org/bot{settings.TELEGRAM_BOT_TOKEN}/setWebhook",
-                json=payload,
+_SETWEBHOOK_URL = f"https://api.telegram.org/bot{settings.TELEGRAM_BOT_TOKEN}/setWebhook"
+_SETWEBHOOK_PAYLOAD: bytes | None = None
+if settings.PUBLIC_BASE_URL:
+    _SETWEBHOOK_PAYLOAD = orjson.dumps({
+        "url": f"{settings.PUBLIC_BASE_URL.rstrip('/')}/telegram/webhook",
+        "secret_token": settings.WEBHOOK_SECRET_TOKEN,
+        # updates are acked right away, so let Telegram deliver in parallel
+        "max_connections": 100,
+        # only messages are handled; don't get POSTed anything else
+        "allowed_updates": ["message"],
+    })
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Shared keep-alive client for our own calls to api.telegram.org
+    app.state.tg_http = httpx.AsyncClient(
+        timeout=15,
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20),
+    )
+    app.state.update_slots = asyncio.Semaphore(UPDATE_CONCURRENCY)
+    # created per lifespan so the app can be started again in the same process
+    app.state.job_queue = asyncio.Queue()
+    app.state.job_executor = tasks.new_executor()
+    app.state.job_workers = []
+    app.state.tmp_dir = None
+
+    # everything above is cleaned up even if startup below fails
+    try:
+        await tg_app.initialize()
+        app.state.tmp_dir = tasks.init_tmp()
+        app.state.job_workers = tasks.start_workers(
+            app.state.job_queue, app.state.job_executor, app.state.tmp_dir
+        )
+
+        if _SETWEBHOOK_PAYLOAD:
+            r = await app.state.tg_http.post(
+                _SETWEBHOOK_URL,
+                content=_SETWEBHOOK_PAYLOAD,
+                headers={"Content-Type": "application/json"},
             )
             logger.info("Webhook set -> %s", r.json())
 
-@app.on_event("shutdown")
-async def on_shutdown():
-    try:
+        yield
+    finally:
+        # drain tasks must not touch tg_app once it is shut down
+        chat_tasks = list(_chat_tasks.values())
+        for t in chat_tasks:
+            t.cancel()
+        await asyncio.gather(*chat_tasks, return_exceptions=True)
+        _chat_tasks.clear()
+        _chat_queues.clear()
+
+        await tasks.stop_workers(app.state.job_workers, app.state.job_executor)
+        tasks.cleanup_tmp(app.state.tmp_dir)
+        await app.state.tg_http.aclose()
         await tg_app.shutdown()
-        await tg_app.stop()
-    except:
-        pass
+
+app = FastAPI(title="Telegram Webhook + FastAPI", default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # ---------------------- Routes ----------------------
+_HEALTHZ_BODY = orjson.dumps({"ok": True})
+
 @app.get("/healthz")
 async def healthz():
-    return {"ok": True}
+    return Response(content=_HEALTHZ_BODY, media_type="application/json")
 
-@app.post("/process", response_model=Out)
+@app.post("/process")
 async def process_endpoint(inp: In):
     """
     Existing simple text endpoint: echoes with 'bhola ' prefix.
+    Returns the response directly, skipping response-model validation.
     """
-    return Out(result=process_text(inp.text))
+    return Response(content=orjson.dumps({"result": process_text(inp.text)}), media_type="application/json")
 
-@app.post("/url-upload")
-async def url_upload_endpoint(payload: dict):
+@app.post("/url-upload", status_code=202)
+async def url_upload_endpoint(inp: UrlUploadIn):
     """
-    NEW route: takes a URL, downloads the video to a temp folder, uploads to YouTube,
-    cleans up the temp files, and returns the YouTube video id + link.
+    Takes a URL and queues a job that downloads the video to a temp folder,
+    uploads it to YouTube and cleans up the temp files. Returns the job id;
+    poll GET /url-upload/{task_id} for the YouTube video id + link.
 
     Body (application/json):
       {
@@ -198,54 +233,35 @@ async def url_upload_endpoint(payload: dict):
         "privacy": "private|unlisted|public"   (optional; default 'private')
       }
     """
-    url = (payload or {}).get("url")
-    if not url:
-        raise HTTPException(status_code=400, detail="Missing 'url' in body")
-
-    title = (payload or {}).get("title")
-    description = (payload or {}).get("description")
-    privacy = (payload or {}).get("privacy") or "private"
-
     # Validate required YouTube env vars
     missing = [k for k in ("YT_CLIENT_ID", "YT_CLIENT_SECRET", "YT_REFRESH_TOKEN") if not os.getenv(k)]
     if missing:
         raise HTTPException(status_code=500, detail=f"Missing env vars: {', '.join(missing)}")
 
-    local_path = None
-    try:
-        # 1) download
-        local_path = download_video(url)
-        print("Downloaded to:", local_path)
-
-        # 2) upload
-        video_id = upload_to_youtube(local_path, title=title, description=description, privacy=privacy)
-        link = f"https://youtu.be/{video_id}"
-
-        return {"ok": True, "video_id": video_id, "link": link}
-
-    except Exception as e:
-        # common Google OAuth errors bubble up here too
-        # e.g. 'invalid_grant' (expired/revoked) or 'unauthorized_client'
-        raise HTTPException(status_code=500, detail=str(e)) from e
+    task_id = tasks.enqueue(app.state.job_queue, str(inp.url), title=inp.title, description=inp.description, privacy=inp.privacy)
+    return {"ok": True, "task_id": task_id}
 
-    finally:
-        # 3) cleanup temp dir/file
-        try:
-            if local_path:
-                tmpdir = os.path.dirname(local_path)
-                if os.path.exists(tmpdir):
-                    shutil.rmtree(tmpdir, ignore_errors=True)
-        except Exception:
-            pass
+@app.get("/url-upload/{task_id}")
+async def url_upload_status(task_id: str):
+    """
+    Status of a queued /url-upload job: queued | running | done | failed.
+    Finished jobs include `video_id` + `link` (or `error`).
+    Jobs are kept in memory, which is why the app runs as a single worker.
+    """
+    job = tasks.jobs.get(task_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown task_id")
+    return job
 
 @app.post("/telegram/webhook")
 async def telegram_webhook(request: Request):
     secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token")
-    if secret != settings.WEBHOOK_SECRET_TOKEN:
+    if not hmac.compare_digest((secret or "").encode(), _EXPECTED_SECRET):
         raise HTTPException(status_code=401, detail="Invalid secret")
 
     body = await request.body()
-    update = Update.de_json(json.loads(body), tg_app.bot)
+    update = Update.de_json(orjson.loads(body), tg_app.bot)
 
-    await tg_app.process_update(update)
+    # Ack first so Telegram doesn't time out and redeliver while we work
+    schedule_update(update)
     return Response(status_code=200)
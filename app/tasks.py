@@ -0,0 +1,390 @@
+# app/tasks.py
+import asyncio
+import functools
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Iterator
+
+import yt_dlp
+from yt_dlp.extractor import gen_extractor_classes
+from cachetools import TTLCache
+from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build
+from googleapiclient.http import MediaFileUpload, MediaUpload, build_http
+
+logger = logging.getLogger("app.tasks")
+
+# Number of download+upload jobs processed at the same time
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+
+# Uploads allowed at once across all jobs. With temp-file downloads, extra
+# workers keep downloading in the meantime so download and upload of different
+# jobs overlap; in streaming mode the download is the upload, so a slot is
+# taken before yt-dlp starts. (YouTube doesn't accept parallel chunk ranges
+# within one upload.)
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "2"))
+_upload_slots = threading.BoundedSemaphore(UPLOAD_CONCURRENCY)
+
+# Finished jobs are kept around for a while so clients can poll their status
+jobs: TTLCache = TTLCache(maxsize=10_000, ttl=6 * 60 * 60)
+
+# Downloads go into per-job subdirectories of one base dir created at startup.
+# Point DOWNLOAD_DIR at a tmpfs (e.g. /dev/shm) to keep them in RAM.
+DOWNLOAD_DIR = os.getenv("DOWNLOAD_DIR") or None
+
+# YouTube throttles long single-connection downloads; 10 MiB ranged requests
+# (yt-dlp's own YouTube default) and parallel fragments get around that
+HTTP_CHUNK_SIZE = 10 * 1024 * 1024
+CONCURRENT_FRAGMENTS = 4
+
+# Extracted video info (formats etc.) so a repeated URL skips extraction.
+# Format URLs handed out by sites like YouTube expire, hence the TTL; an entry
+# whose download fails is dropped and re-extracted (see download_video).
+_info_cache: TTLCache = TTLCache(maxsize=1024, ttl=60 * 60)
+_info_lock = threading.Lock()
+
+# Pipe yt-dlp's output straight into the YouTube upload instead of going through
+# a temp file (opt-in: needs a single-file format and gives up upload retries
+# across restarts)
+STREAM_UPLOAD = os.getenv("YT_STREAM_UPLOAD", "0") == "1"
+
+# Each resumable chunk is a separate HTTP round-trip, so keep them big;
+# files up to SINGLE_REQUEST_MAX go up in one request
+UPLOAD_CHUNKSIZE = 16 * 1024 * 1024
+SINGLE_REQUEST_MAX = 200 * 1024 * 1024
+
+# ---------------------- YouTube Helpers ----------------------
+def init_tmp() -> str:
+    return tempfile.mkdtemp(prefix="ytbot_", dir=DOWNLOAD_DIR)
+
+
+def cleanup_tmp(base_tmp: str | None):
+    if base_tmp:
+        shutil.rmtree(base_tmp, ignore_errors=True)
+
+
+@functools.lru_cache(maxsize=1024)
+def _video_key(url: str) -> str:
+    """
+    Canonical cache key for `url`: extractor + video id when yt-dlp can tell
+    them from the URL alone (so youtu.be/x and youtube.com/watch?v=x match).
+    """
+    for ie in gen_extractor_classes():
+        if ie.suitable(url):
+            video_id = ie.get_temp_id(url)
+            return f"{ie.ie_key()}:{video_id}" if video_id else url
+    return url
+
+
+def _extract_info(ydl: yt_dlp.YoutubeDL, url: str) -> tuple[dict, bool]:
+    """
+    Returns the info for `url` and whether it came from the cache.
+    """
+    key = _video_key(url)
+    with _info_lock:
+        info = _info_cache.get(key)
+    cached = info is not None
+    if not cached:
+        info = ydl.extract_info(url, download=False)
+        with _info_lock:
+            _info_cache[key] = info
+    # fresh copy without the previous run's download state, like --load-info-json
+    return ydl.sanitize_info(info, remove_private_keys=True), cached
+
+
+def _forget_info(url: str):
+    with _info_lock:
+        _info_cache.pop(_video_key(url), None)
+
+
+@contextmanager
+def download_video(url: str, base_tmp: str | None = None) -> Iterator[str]:
+    """
+    Downloads a video into a fresh subdirectory of `base_tmp` (the OS temp dir
+    if None) and yields the full local file path. The subdirectory is removed
+    when the block exits.
+    """
+    with tempfile.TemporaryDirectory(dir=base_tmp, ignore_cleanup_errors=True) as tmpdir:
+        outtmpl = os.path.join(tmpdir, "%(title)s.%(ext)s")
+
+        ydl_opts = {
+            "outtmpl": outtmpl,
+            "format": "best",
+            "noplaylist": True,
+            "quiet": True,
+            "buffersize": 64 * 1024,
+            "http_chunk_size": HTTP_CHUNK_SIZE,
+            "concurrent_fragment_downloads": CONCURRENT_FRAGMENTS,
+            # skip fetching the player config page (one less round-trip)
+            "extractor_args": {"youtube": {"player_skip": ["configs"]}},
+        }
+
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info, cached = _extract_info(ydl, url)
+            try:
+                info = ydl.process_ie_result(info, download=True)
+            except Exception:
+                # cached format URLs may have expired or been tied to a session;
+                # don't keep serving them, and retry once with a fresh extraction
+                _forget_info(url)
+                if not cached:
+                    raise
+                logger.info("Download from cached info failed, re-extracting: %s", url)
+                info, _ = _extract_info(ydl, url)
+                try:
+                    info = ydl.process_ie_result(info, download=True)
+                except Exception:
+                    _forget_info(url)
+                    raise
+            filename = ydl.prepare_filename(info)  # full path to downloaded file
+
+        yield filename
+
+
+# Built once and shared by all uploads (see build_youtube_client)
+_yt_client = None
+_yt_creds: Credentials | None = None
+_yt_lock = threading.Lock()
+_yt_http = threading.local()
+
+
+def build_youtube_client():
+    """
+    Returns the shared YouTube service, building it on first use. The
+    credentials refresh their access token by themselves when it expires.
+    """
+    global _yt_client, _yt_creds
+    if _yt_client is None:
+        with _yt_lock:
+            if _yt_client is None:
+                _yt_creds = Credentials(
+                    token=None,
+                    refresh_token=os.getenv("YT_REFRESH_TOKEN"),
+                    client_id=os.getenv("YT_CLIENT_ID"),
+                    client_secret=os.getenv("YT_CLIENT_SECRET"),
+                    token_uri="https://oauth2.googleapis.com/token",
+                    scopes=["https://www.googleapis.com/auth/youtube.upload"],
+                )
+                _yt_client = build(
+                    "youtube", "v3", credentials=_yt_creds, cache_discovery=False, static_discovery=True
+                )
+    return _yt_client
+
+
+def _authorized_http() -> AuthorizedHttp:
+    # httplib2 isn't thread-safe, so uploads running in parallel can't share
+    # the service's own transport. Each pool thread keeps one keep-alive
+    # transport over the shared credentials and reuses it for every upload.
+    http = getattr(_yt_http, "http", None)
+    if http is None:
+        http = _yt_http.http = AuthorizedHttp(_yt_creds, http=build_http())
+    return http
+
+
+def _insert_video(media: MediaUpload, title: str | None = None, description: str | None = None, privacy: str = "private") -> str:
+    youtube = build_youtube_client()
+
+    body = {
+        "snippet": {
+            "title": title or "Uploaded via Bot",
+            "description": description or "Auto-uploaded video",
+        },
+        "status": {"privacyStatus": privacy},
+    }
+
+    request = youtube.videos().insert(
+        part="snippet,status", body=body, media_body=media
+    )
+
+    http = _authorized_http()
+    response = None
+    while response is None:
+        _, response = request.next_chunk(http=http)
+
+    return response.get("id")
+
+
+def upload_to_youtube(video_path: str, title: str | None = None, description: str | None = None, privacy: str = "private") -> str:
+    chunksize = -1 if os.path.getsize(video_path) <= SINGLE_REQUEST_MAX else UPLOAD_CHUNKSIZE
+    media = MediaFileUpload(video_path, chunksize=chunksize, resumable=True)
+    with _upload_slots:
+        return _insert_video(media, title=title, description=description, privacy=privacy)
+
+
+class PipeUpload(MediaUpload):
+    """
+    Resumable upload fed from a non-seekable stream (e.g. a subprocess pipe).
+
+    The total size stays unknown until EOF. Bytes the server hasn't
+    acknowledged yet are kept in memory so a chunk can be re-sent, and one
+    chunk is read ahead so the last chunk always goes out with the final size.
+    """
+
+    def __init__(self, fd, mimetype: str = "video/*", chunksize: int = UPLOAD_CHUNKSIZE, on_eof: Callable[[], None] | None = None):
+        super().__init__()
+        self._fd = fd
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        self._on_eof = on_eof
+        self._buf = bytearray()
+        self._offset = 0  # stream position of self._buf[0]
+        self._next = 0    # where the next chunk will most likely start
+        self._eof = False
+
+    def _fill(self, end: int):
+        while not self._eof and self._offset + len(self._buf) < end:
+            data = self._fd.read(end - self._offset - len(self._buf))
+            if not data:
+                self._eof = True
+                if self._on_eof:
+                    self._on_eof()
+            else:
+                self._buf += data
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        self._fill(self._next + self._chunksize + 1)
+        return self._offset + len(self._buf) if self._eof else None
+
+    def resumable(self):
+        return True
+
+    def getbytes(self, begin, length):
+        if begin < self._offset:
+            raise ValueError("Cannot rewind a pipe upload")
+        # everything before `begin` has been acknowledged by the server
+        del self._buf[: begin - self._offset]
+        self._offset = begin
+        self._fill(begin + length)
+        data = bytes(self._buf[:length])
+        self._next = begin + len(data)
+        return data
+
+
+def stream_to_youtube(url: str, title: str | None = None, description: str | None = None, privacy: str = "private") -> str:
+    """
+    Downloads with yt-dlp to stdout and uploads the bytes as they arrive,
+    so nothing lands on disk and the upload overlaps the download.
+    """
+    cmd = [
+        sys.executable, "-m", "yt_dlp", "-f", "best", "--no-playlist", "-q", "--no-warnings",
+        "--buffer-size", str(64 * 1024),
+        "--http-chunk-size", str(HTTP_CHUNK_SIZE),
+        "--concurrent-fragments", str(CONCURRENT_FRAGMENTS),
+        "--extractor-args", "youtube:player_skip=configs",
+        "-o", "-", "--", url,
+    ]
+
+    # Take the upload slot before spawning yt-dlp: while waiting for one it
+    # would fill the pipe, stall, and likely get dropped by the source server
+    with _upload_slots, tempfile.TemporaryFile() as err:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=err)
+
+        def check_exit():
+            # raise before the final chunk goes out so a failed download never
+            # gets published as a truncated video
+            if proc.wait() != 0:
+                err.seek(0)
+                msg = err.read().decode(errors="replace").strip()
+                raise RuntimeError(msg or f"yt-dlp exited with code {proc.returncode}")
+
+        try:
+            media = PipeUpload(proc.stdout, on_eof=check_exit)
+            return _insert_video(media, title=title, description=description, privacy=privacy)
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+            proc.stdout.close()
+            proc.wait()
+
+# ---------------------- Jobs ----------------------
+def process_url(url: str, title: str | None = None, description: str | None = None, privacy: str = "private", base_tmp: str | None = None) -> str:
+    """
+    Downloads the video behind `url`, uploads it to YouTube and returns the
+    YouTube video id. Temp files are gone once this returns or raises.
+    """
+    if STREAM_UPLOAD:
+        return stream_to_youtube(url, title=title, description=description, privacy=privacy)
+
+    with download_video(url, base_tmp) as local_path:
+        logger.info("Downloaded to: %s", local_path)
+        return upload_to_youtube(local_path, title=title, description=description, privacy=privacy)
+
+
+def enqueue(
+    queue: asyncio.Queue,
+    url: str,
+    title: str | None = None,
+    description: str | None = None,
+    privacy: str = "private",
+    on_done: Callable[[dict], Awaitable[None]] | None = None,
+) -> str:
+    """
+    Puts a download+upload job on `queue` and returns its id right away.
+    `on_done` is awaited with the finished job (e.g. to reply on Telegram).
+    """
+    job_id = uuid.uuid4().hex
+    jobs[job_id] = {"task_id": job_id, "status": "queued", "url": url}
+    queue.put_nowait((job_id, url, title, description, privacy, on_done))
+    return job_id
+
+
+async def _worker(queue: asyncio.Queue, executor: ThreadPoolExecutor, base_tmp: str | None):
+    while True:
+        job_id, url, title, description, privacy, on_done = await queue.get()
+        job = jobs.get(job_id) or {"task_id": job_id, "url": url}
+        job["status"] = "running"
+        try:
+            video_id = await asyncio.get_running_loop().run_in_executor(
+                executor,
+                functools.partial(
+                    process_url, url, title=title, description=description, privacy=privacy, base_tmp=base_tmp
+                ),
+            )
+            job.update(status="done", video_id=video_id, link=f"https://youtu.be/{video_id}")
+        except Exception as e:
+            # common Google OAuth errors bubble up here too
+            # e.g. 'invalid_grant' (expired/revoked) or 'unauthorized_client'
+            logger.exception("Job %s failed", job_id)
+            job.update(status="failed", error=str(e))
+        finally:
+            jobs[job_id] = job
+            queue.task_done()
+
+        if on_done:
+            try:
+                await on_done(job)
+            except Exception:
+                logger.exception("Job %s: on_done callback failed", job_id)
+
+
+def new_executor() -> ThreadPoolExecutor:
+    # yt-dlp and googleapiclient are blocking; jobs run here to keep the event loop free
+    return ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="yt-job")
+
+
+def start_workers(
+    queue: asyncio.Queue, executor: ThreadPoolExecutor, base_tmp: str | None = None, n: int = JOB_WORKERS
+) -> list[asyncio.Task]:
+    return [asyncio.create_task(_worker(queue, executor, base_tmp)) for _ in range(n)]
+
+
+async def stop_workers(workers: list[asyncio.Task], executor: ThreadPoolExecutor):
+    for w in workers:
+        w.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    executor.shutdown(wait=False, cancel_futures=True)